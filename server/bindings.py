@@ -1,16 +1,59 @@
+import re
 from copy import deepcopy
-from typing import Any, Dict, Optional, Tuple, List
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
 
 
-def get_context_value(ctx: Dict[str, Any], path: str) -> Optional[Any]:
+_SELECTOR_RE = re.compile(r'^(?P<name>[^\[\]]*)\[(?P<key>[^=\[\]]+)=(?P<value>[^\[\]]*)\]$')
+
+
+class _KeySelector(NamedTuple):
+    """Сегмент пути вида [key=value]: выбор элемента списка по значению ключа."""
+    key: str
+    value: str
+
+
+@lru_cache(maxsize=1024)
+def _parse_path(path: str) -> Tuple[Any, ...]:
     """
-    Получение значения из контекста по dot-path. Поддерживает числовые индексы для списков.
-    Возвращает None, если путь не найден.
+    Разбирает dot-path на сегменты. 'cart.items[id=42].quantity' ->
+    ('cart', 'items', _KeySelector('id', '42'), 'quantity').
+    Точки внутри квадратных скобок не считаются разделителями.
     """
-    if not path:
-        return None
+    raw: List[str] = []
+    buf = ''
+    depth = 0
+    for ch in path:
+        if ch == '[':
+            depth += 1
+        elif ch == ']':
+            depth = max(depth - 1, 0)
+        if ch == '.' and depth == 0:
+            raw.append(buf)
+            buf = ''
+        else:
+            buf += ch
+    raw.append(buf)
+
+    segments: List[Any] = []
+    for seg in raw:
+        match = _SELECTOR_RE.match(seg)
+        if not match:
+            segments.append(seg)
+            continue
+        if match.group('name'):
+            segments.append(match.group('name'))
+        segments.append(_KeySelector(match.group('key').strip(), match.group('value').strip()))
+    return tuple(segments)
+
+
+def _is_plain_path(path: str) -> bool:
+    return '[' not in path and '*' not in path
+
+
+def _get_by_segments(ctx: Any, segments: Sequence[str]) -> Optional[Any]:
     node = ctx
-    for seg in path.split('.'):
+    for seg in segments:
         if isinstance(node, list):
             try:
                 idx = int(seg)
@@ -27,6 +70,337 @@ def get_context_value(ctx: Dict[str, Any], path: str) -> Optional[Any]:
     return node
 
 
+def _pattern_matches(pattern: Sequence[str], path: Sequence[str]) -> bool:
+    """Сравнивает конкретный путь с шаблоном той же длины; '*' в шаблоне совпадает с любым сегментом."""
+    if len(pattern) != len(path):
+        return False
+    return all(p == '*' or p == s for p, s in zip(pattern, path))
+
+
+def _iter_collections(ctx: Any, pattern: Sequence[str]) -> Iterator[Tuple[Tuple[str, ...], list]]:
+    """Перебирает все списки, подходящие под шаблон (с раскрытием '*' по элементам списков)."""
+    def walk(node: Any, depth: int, prefix: Tuple[str, ...]):
+        if depth == len(pattern):
+            if isinstance(node, list):
+                yield prefix, node
+            return
+        seg = pattern[depth]
+        if seg == '*':
+            if isinstance(node, list):
+                for i, child in enumerate(node):
+                    yield from walk(child, depth + 1, prefix + (str(i),))
+            return
+        child = _get_by_segments(node, (seg,))
+        if child is not None:
+            yield from walk(child, depth + 1, prefix + (seg,))
+
+    yield from walk(ctx, 0, ())
+
+
+def _location_order(location: Tuple[str, ...]) -> Tuple[Tuple[int, Any], ...]:
+    # порядок обхода коллекций: числовые сегменты сравниваются как числа
+    return tuple((0, int(seg)) if seg.isdigit() else (1, seg) for seg in location)
+
+
+_SCAN = object()
+
+
+class _ContextIndex:
+    """
+    Вторичный индекс коллекции контекста: str(значение ключа) -> конкретный путь к элементу.
+    collection — шаблон пути к списку ('*' раскрывается по всем элементам вложенных списков),
+    key — dot-path поля внутри элемента (например 'id' или 'advertisement.id').
+    Строится лениво — при втором поиске (одиночный поиск дешевле сделать линейно,
+    чем строить индекс) или перед копированием уже использованного контекста.
+    При повторяющихся ключах, как и линейный поиск, указывает на первый элемент в порядке обхода.
+    """
+
+    def __init__(self, collection: Tuple[str, ...], key: str):
+        self.collection = collection
+        self.key = key
+        self.key_segments = tuple(key.split('.'))
+        self.built = False
+        self.lookups = 0
+        self.locations: Dict[str, Tuple[str, ...]] = {}
+        self.keys_by_location: Dict[Tuple[str, ...], str] = {}
+        self.duplicates: Set[str] = set()
+
+    def _key_of(self, item: Any) -> Optional[str]:
+        value = _get_by_segments(item, self.key_segments)
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        return str(value)
+
+    def _add(self, location: Tuple[str, ...], item: Any):
+        key_value = self._key_of(item)
+        if key_value is None:
+            return
+        self.keys_by_location[location] = key_value
+        existing = self.locations.get(key_value)
+        if existing is not None and existing != location:
+            self.duplicates.add(key_value)
+            if _location_order(existing) < _location_order(location):
+                return
+        self.locations[key_value] = location
+
+    def invalidate(self):
+        self.built = False
+        self.locations = {}
+        self.keys_by_location = {}
+        self.duplicates = set()
+
+    def rebuild(self, ctx: Dict[str, Any]):
+        self.invalidate()
+        for prefix, items in _iter_collections(ctx, self.collection):
+            for i, item in enumerate(items):
+                self._add(prefix + (str(i),), item)
+        self.built = True
+
+    def reindex_item(self, ctx: Dict[str, Any], location: Tuple[str, ...]):
+        old_key = self.keys_by_location.pop(location, None)
+        if old_key is not None and old_key in self.duplicates:
+            # под старым ключом мог прятаться другой элемент — проще перестроить при следующем поиске
+            self.invalidate()
+            return
+        if old_key is not None and self.locations.get(old_key) == location:
+            del self.locations[old_key]
+        self._add(location, _get_by_segments(ctx, location))
+
+    def affected_by(self, path: Tuple[str, ...]) -> Optional[Any]:
+        """
+        Что нужно сделать с индексом после записи по конкретному пути path:
+        None — ничего, 'invalidate' — заменена коллекция или её предок,
+        кортеж-позиция — переиндексировать один элемент (заменён он сам или его ключ).
+        """
+        if not self.built:
+            return None
+        size = len(self.collection)
+        if not _pattern_matches(self.collection[:len(path)], path[:size]):
+            return None
+        if len(path) <= size:
+            return 'invalidate'
+        inner = path[size + 1:]
+        if inner == self.key_segments[:len(inner)]:
+            return path[:size + 1]
+        return None
+
+    def copy(self) -> '_ContextIndex':
+        # значения карт — неизменяемые кортежи/строки, поэтому хватает поверхностной копии
+        copied = _ContextIndex(self.collection, self.key)
+        copied.built = self.built
+        copied.lookups = self.lookups
+        copied.locations = dict(self.locations)
+        copied.keys_by_location = dict(self.keys_by_location)
+        copied.duplicates = set(self.duplicates)
+        return copied
+
+
+class IndexedContext(dict):
+    """
+    Контекст с объявленными вторичными индексами. Ведёт себя как обычный dict
+    (сериализуется в JSON как есть). Копии контекста разделяют объекты индексов,
+    индекс копируется только перед первым изменением (copy-on-write), поэтому
+    запись, не затрагивающая ключи индекса, не платит за его копию.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.indexes: List[_ContextIndex] = []
+        self._shared: Set[int] = set()
+
+    def _share_indexes(self, copied: 'IndexedContext'):
+        # использованный индекс строится до разделения, иначе каждая копия строила бы его заново
+        for index in list(self.indexes):
+            if not index.built and index.lookups:
+                self.own_index(index).rebuild(self)
+        self._shared.update(id(index) for index in self.indexes)
+        copied.indexes = list(self.indexes)
+        copied._shared = set(self._shared)
+
+    def shallow_copy(self) -> 'IndexedContext':
+        copied = IndexedContext(self)
+        self._share_indexes(copied)
+        return copied
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> 'IndexedContext':
+        copied = IndexedContext()
+        memo[id(self)] = copied
+        for key, value in self.items():
+            copied[key] = deepcopy(value, memo)
+        self._share_indexes(copied)
+        return copied
+
+    def own_index(self, index: _ContextIndex) -> _ContextIndex:
+        """Возвращает индекс, который можно менять: разделённый с другим контекстом сначала копируется."""
+        if id(index) not in self._shared:
+            return index
+        owned = index.copy()
+        self.indexes = [owned if i is index else i for i in self.indexes]
+        self._shared.discard(id(index))
+        return owned
+
+    def find_index(self, collection: Sequence[str], key: str) -> Optional[_ContextIndex]:
+        for index in self.indexes:
+            if index.key == key and _pattern_matches(index.collection, collection):
+                return index
+        return None
+
+    def lookup(self, index: _ContextIndex, key_value: str) -> Any:
+        """
+        Положение элемента с ключом key_value, None при промахе или _SCAN, если индекс
+        ещё не построен и первый поиск выгоднее сделать линейно.
+        Промах по построенному индексу считается достоверным (иначе каждый промах стоил бы O(n)):
+        после изменений в обход set_context_value вызывайте rebuild_context_indexes().
+        Устаревшее попадание (по позиции лежит другой элемент) перестраивает индекс один раз.
+        """
+        if not index.built:
+            # счётчик — статистика использования, его можно менять и у разделённого индекса
+            index.lookups += 1
+            if index.lookups == 1:
+                return _SCAN
+            index = self.own_index(index)
+            index.rebuild(self)
+        location = index.locations.get(key_value)
+        if location is None:
+            return None
+        if index._key_of(_get_by_segments(self, location)) != key_value:
+            index = self.own_index(index)
+            index.rebuild(self)
+            location = index.locations.get(key_value)
+        return location
+
+    def on_set(self, path: Tuple[str, ...]):
+        """Инкрементально обновляет индексы после записи по конкретному пути path."""
+        for index in list(self.indexes):
+            action = index.affected_by(path)
+            if action is None:
+                continue
+            index = self.own_index(index)
+            if action == 'invalidate':
+                index.invalidate()
+            else:
+                index.reindex_item(self, action)
+
+
+def declare_context_index(ctx: Dict[str, Any], collection_path: str, key: str = 'id') -> 'IndexedContext':
+    """
+    Объявляет вторичный индекс id -> положение элемента для коллекции контекста.
+    collection_path — dot-path к списку, '*' раскрывает вложенные списки
+    (например 'cart_response.shop_groups.*.items'). Если ctx ещё не IndexedContext,
+    возвращается новая обёртка верхнего уровня — используйте результат вместо исходного ctx.
+    Индекс строится при втором поиске по селектору, дальше поддерживается
+    set_context_value/apply_context_patch, и элементы путями вида 'cart.items[id=42].quantity'
+    находятся за O(1).
+    """
+    indexed = ctx if isinstance(ctx, IndexedContext) else IndexedContext(ctx)
+    collection = tuple(collection_path.split('.')) if collection_path else ()
+    existing = next((i for i in indexed.indexes if i.collection == collection and i.key == key), None)
+    if existing is None:
+        indexed.indexes.append(_ContextIndex(collection, key))
+    else:
+        indexed.own_index(existing).invalidate()
+    return indexed
+
+
+def rebuild_context_indexes(ctx: Dict[str, Any]):
+    """Полностью перестраивает индексы контекста (после изменений в обход set_context_value)."""
+    if not isinstance(ctx, IndexedContext):
+        return
+    for index in list(ctx.indexes):
+        ctx.own_index(index).rebuild(ctx)
+
+
+def _selector_value(selector: _KeySelector, scope: Dict[str, Any]) -> Optional[str]:
+    """Значение селектора: литерал или '${path}', разрешённый против scope."""
+    value = selector.value
+    if value.startswith('${') and value.endswith('}'):
+        resolved = get_context_value(scope, normalize_reference(value))
+        if resolved is None or isinstance(resolved, (dict, list)):
+            return None
+        return str(resolved)
+    return value
+
+
+def _select_item(ctx: Dict[str, Any], node: Any, concrete: Tuple[str, ...], selector: _KeySelector,
+                 scope: Dict[str, Any]) -> Optional[Tuple[str, ...]]:
+    """Находит конкретный путь к элементу коллекции concrete, у которого key == value."""
+    key_value = _selector_value(selector, scope)
+    if key_value is None:
+        return None
+    index = ctx.find_index(concrete, selector.key) if isinstance(ctx, IndexedContext) else None
+    if index is not None:
+        location = ctx.lookup(index, key_value)
+        if location is not _SCAN:
+            if location is None or not _pattern_matches(concrete, location[:-1]):
+                return None
+            return location
+
+    # индекса нет (или он ещё не построен) — линейный поиск
+    key_segments = tuple(selector.key.split('.'))
+    if '*' in concrete:
+        collections = _iter_collections(ctx, concrete)
+    else:
+        collections = [(concrete, node)] if isinstance(node, list) else []
+    for prefix, items in collections:
+        for i, item in enumerate(items):
+            value = _get_by_segments(item, key_segments)
+            if value is not None and str(value) == key_value:
+                return prefix + (str(i),)
+    return None
+
+
+def _locate(ctx: Dict[str, Any], path: str, scope: Optional[Dict[str, Any]] = None) -> Optional[Tuple[str, ...]]:
+    """
+    Превращает путь с селекторами [key=value] и '*' в конкретный позиционный путь.
+    Значение селектора может быть ссылкой ('items[id=${selected_item_id}]'), она разрешается
+    против scope (по умолчанию — против самого ctx).
+    Хвост после последнего селектора может не существовать (нужно для записи).
+    Возвращает None, если элемент не найден или за '*' не следует селектор.
+    """
+    scope = ctx if scope is None else scope
+    node: Any = ctx
+    concrete: Tuple[str, ...] = ()
+    for seg in _parse_path(path):
+        if isinstance(seg, _KeySelector):
+            location = _select_item(ctx, node, concrete, seg, scope)
+            if location is None:
+                return None
+            concrete = location
+            node = _get_by_segments(ctx, location)
+            continue
+        concrete += (seg,)
+        node = None if seg == '*' or node is None else _get_by_segments(node, (seg,))
+    if '*' in concrete:
+        return None
+    return concrete
+
+
+def locate_context_path(ctx: Dict[str, Any], path: str) -> Optional[str]:
+    """Возвращает позиционный dot-path для пути с селекторами ('cart.items[id=42]' -> 'cart.items.3')."""
+    if not path:
+        return None
+    if _is_plain_path(path):
+        return path
+    concrete = _locate(ctx, path)
+    return '.'.join(concrete) if concrete is not None else None
+
+
+def get_context_value(ctx: Dict[str, Any], path: str) -> Optional[Any]:
+    """
+    Получение значения из контекста по dot-path. Поддерживает числовые индексы для списков
+    и выбор элемента по ключу ('cart.items[id=42].quantity', 'groups.*.items[id=42]').
+    Возвращает None, если путь не найден.
+    """
+    if not path:
+        return None
+    if _is_plain_path(path):
+        return _get_by_segments(ctx, path.split('.'))
+    concrete = _locate(ctx, path)
+    if concrete is None:
+        return None
+    return _get_by_segments(ctx, concrete)
+
+
 def is_binding(obj: Any) -> bool:
     """Определяет, является ли объект binding-описанием: словарь с ключом 'reference'"""
     return isinstance(obj, dict) and 'reference' in obj and isinstance(obj['reference'], str)
@@ -68,11 +442,7 @@ def flatten_patch(prefix: str, value: Any, out: Dict[str, Any]):
         out[prefix] = value
 
 
-def set_context_value(ctx: Dict[str, Any], path: str, value: Any):
-    """Устанавливает значение в dict ctx по dot-path, создавая словари/списки по необходимости.
-    Упрощённая реализация, покрывающая типичные случаи.
-    """
-    parts = path.split('.') if path else []
+def _assign(ctx: Dict[str, Any], parts: Sequence[str], value: Any):
     node = ctx
     for i, p in enumerate(parts):
         last = (i == len(parts) - 1)
@@ -101,36 +471,202 @@ def set_context_value(ctx: Dict[str, Any], path: str, value: Any):
             if last:
                 node[p] = value
                 return
-            if p not in node or not isinstance(node[p], dict):
+            child = node.get(p)
+            # в существующий список спускаемся только по числовому индексу,
+            # иначе (как и раньше) заменяем узел словарём
+            keep_list = isinstance(child, list) and parts[i + 1].isdigit()
+            if not isinstance(child, dict) and not keep_list:
                 node[p] = {}
             node = node[p]
 
 
-def recompute_derived(ctx: Dict[str, Any]):
-    """Пример рекомпутации: пересчитать data.order.total и totalFormatted по сумме data.cart.items[].price"""
+def _own_path(ctx: Dict[str, Any], parts: Sequence[str], owned: Set[int]):
+    """
+    Copy-on-write: поверхностно копирует контейнеры вдоль parts[:-1], которые ещё разделены
+    с исходным контекстом, чтобы последующая запись не затронула исходник.
+    """
+    node: Any = ctx
+    for p in parts[:-1]:
+        if isinstance(node, dict):
+            key: Any = p
+            child = node.get(p)
+        elif isinstance(node, list) and p.isdigit() and int(p) < len(node):
+            key = int(p)
+            child = node[key]
+        else:
+            return
+        if not isinstance(child, (dict, list)):
+            return
+        if id(child) not in owned:
+            child = dict(child) if isinstance(child, dict) else list(child)
+            node[key] = child
+            owned.add(id(child))
+        node = child
+
+
+def _set_value(ctx: Dict[str, Any], path: str, value: Any, source_context: Optional[Dict[str, Any]],
+               owned: Optional[Set[int]]) -> Optional[str]:
+    if path and not _is_plain_path(path):
+        concrete = _locate(ctx, path, source_context)
+        if concrete is None:
+            return None
+        parts: Sequence[str] = concrete
+    else:
+        parts = path.split('.') if path else []
+    if owned is not None:
+        _own_path(ctx, parts, owned)
+    _assign(ctx, parts, value)
+    if isinstance(ctx, IndexedContext) and parts:
+        ctx.on_set(tuple(parts))
+    return '.'.join(parts)
+
+
+def set_context_value(ctx: Dict[str, Any], path: str, value: Any, source_context: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Устанавливает значение в dict ctx по dot-path, создавая словари/списки по необходимости.
+    Упрощённая реализация, покрывающая типичные случаи.
+    Пути с селекторами [key=value] пишут в найденный элемент; если элемент не найден — запись пропускается.
+    Ссылки '${...}' в селекторах разрешаются против source_context (по умолчанию — против ctx).
+    Объявленные индексы IndexedContext обновляются инкрементально.
+    Возвращает позиционный путь, по которому произошла запись (None, если запись пропущена).
+    """
+    return _set_value(ctx, path, value, source_context, None)
+
+
+# Что читает и пишет recompute_derived — по этим путям кэш переходов в sandbox_flow
+# строит отпечаток и плоский patch; держите их в согласии с телом функции.
+DERIVED_READ_PATHS: Tuple[str, ...] = ('data.cart.items',)
+DERIVED_WRITE_PATHS: Tuple[str, ...] = ('data.order.total', 'data.order.totalFormatted')
+# запись по этим путям (или их предкам) делает производные значения устаревшими
+_DERIVED_DEPENDENCIES: Tuple[str, ...] = ('data.cart.items.*.price',) + DERIVED_WRITE_PATHS
+
+
+def _segments_overlap(a: Sequence[Any], b: Sequence[Any]) -> bool:
+    # '*' и селектор совпадают с любым сегментом
+    for x, y in zip(a, b):
+        if x == '*' or y == '*' or isinstance(x, _KeySelector) or isinstance(y, _KeySelector):
+            continue
+        if x != y:
+            return False
+    return True
+
+
+def paths_overlap(a: str, b: str) -> bool:
+    """
+    Может ли запись по одному пути затронуть значение по другому: пути совпадают
+    или один из них — предок другого. '*' и селекторы [key=value] совпадают с любым сегментом.
+    """
+    return _segments_overlap(_parse_path(a) if a else (), _parse_path(b) if b else ())
+
+
+def derived_inputs_written(paths: Iterable[str]) -> bool:
+    """Затрагивает ли запись по paths (позиционным или с селекторами) входы или результаты recompute_derived."""
+    return any(paths_overlap(path, dependency) for path in paths for dependency in _DERIVED_DEPENDENCIES)
+
+
+def _render_path(segments: Sequence[Any]) -> str:
+    parts: List[str] = []
+    for seg in segments:
+        if isinstance(seg, _KeySelector) and parts:
+            parts[-1] += f'[{seg.key}={seg.value}]'
+        elif isinstance(seg, _KeySelector):
+            parts.append(f'[{seg.key}={seg.value}]')
+        else:
+            parts.append(seg)
+    return '.'.join(parts)
+
+
+class SelectorDependency(NamedTuple):
+    collection: str            # путь коллекции перед селектором, обрезанный до первого '*'
+    item_keys: str             # шаблон ключей элементов ('cart.items.*.id'): запись по нему сдвигает выбор
+    reference: Optional[str]   # путь ссылки из '${...}' или None для литерала
+
+
+def selector_dependencies(path: str) -> List[SelectorDependency]:
+    """
+    Что, кроме самого path, определяет, какой элемент выберут его селекторы [key=value].
+    'cart.items[id=${selected_item_id}].quantity' ->
+    [SelectorDependency('cart.items', 'cart.items.*.id', 'selected_item_id')].
+    """
+    segments = _parse_path(path)
+    dependencies: List[SelectorDependency] = []
+    for i, seg in enumerate(segments):
+        if not isinstance(seg, _KeySelector):
+            continue
+        collection = segments[:i]
+        readable = collection[:collection.index('*')] if '*' in collection else collection
+        value = seg.value
+        reference = normalize_reference(value) if value.startswith('${') and value.endswith('}') else None
+        dependencies.append(SelectorDependency(_render_path(readable), _render_path(collection + ('*', seg.key)), reference))
+    return dependencies
+
+
+def derived_is_current(ctx: Dict[str, Any]) -> bool:
+    """Есть ли в контексте уже посчитанные производные значения (data.order.total)."""
+    order = get_context_value(ctx, 'data.order')
+    return isinstance(order, dict) and 'total' in order
+
+
+def _derived_values(ctx: Dict[str, Any]) -> Optional[Tuple[int, str]]:
     try:
-        items = get_context_value(ctx, 'data.cart.items') or []
+        data = ctx.get('data')
+        order = data.get('order') if isinstance(data, dict) else None
+        if (data is not None and not isinstance(data, dict)) or (order is not None and not isinstance(order, dict)):
+            return None
+        items = get_context_value(ctx, DERIVED_READ_PATHS[0]) or []
         total = 0
         for it in items:
             if isinstance(it, dict) and isinstance(it.get('price'), (int, float)):
                 total += int(it['price'])
-        ctx.setdefault('data', {})
-        ctx['data'].setdefault('order', {})
-        ctx['data']['order']['total'] = total
-        ctx['data']['order']['totalFormatted'] = f"{total:,d}".replace(',', ' ') + ' ₽'
+        return total, f"{total:,d}".replace(',', ' ') + ' ₽'
     except Exception:
         # не ломаем при ошибках — в реальном приложении логировать
-        pass
+        return None
+
+
+def recompute_derived(ctx: Dict[str, Any]):
+    """Пример рекомпутации: пересчитать data.order.total и totalFormatted по сумме data.cart.items[].price"""
+    derived = _derived_values(ctx)
+    if derived is None:
+        return
+    for path, value in zip(DERIVED_WRITE_PATHS, derived):
+        set_context_value(ctx, path, value)
 
 
-def apply_context_patch(source_context: Dict[str, Any], patch: Dict[str, Any], trace_enabled: bool = False) -> Tuple[Dict[str, Any], Optional[List[Dict]]]:
+def apply_flat_values(source_context: Dict[str, Any], values: Iterable[Tuple[str, Any]]) -> Dict[str, Any]:
+    """
+    Записывает готовые значения по позиционным путям в копию source_context (copy-on-write,
+    как apply_context_patch, но без разрешения binding-ов и recompute_derived) — для повтора
+    уже вычисленного плоского patch. Значения не копируются.
     """
-    Применяет patch к source_context и возвращает новую копию next_context.
-    Binding-ы внутри patch разрешаются относительно source_context (не по промежуточным результатам).
+    next_ctx = _shallow_copy_context(source_context)
+    owned: Set[int] = {id(next_ctx)}
+    for path, value in values:
+        _set_value(next_ctx, path, value, None, owned)
+    return next_ctx
+
+
+def _shallow_copy_context(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    return ctx.shallow_copy() if isinstance(ctx, IndexedContext) else dict(ctx)
+
+
+def apply_context_patch(source_context: Dict[str, Any], patch: Dict[str, Any], trace_enabled: bool = False,
+                        written: Optional[List[str]] = None) -> Tuple[Dict[str, Any], Optional[List[Dict]]]:
+    """
+    Применяет patch к source_context и возвращает новый next_context (copy-on-write):
+    копируются только словари/списки вдоль записываемых путей, остальные поддеревья
+    разделяются с source_context — не изменяйте их на месте. Запись по селектору с
+    объявленным индексом стоит O(глубины пути), а не O(размера контекста).
+    Binding-ы внутри patch (и ссылки в селекторах ключей вида 'items[id=${selected_item_id}]')
+    разрешаются относительно source_context (не по промежуточным результатам).
+    Производные значения пересчитываются, только если patch затронул data.cart/data.order
+    или их ещё нет в контексте.
+    written — опциональный список, куда добавляются позиционные пути всех записей.
     Возвращает (next_context, trace?) где trace — список операций, если trace_enabled.
     """
     trace = [] if trace_enabled else None
-    next_ctx = deepcopy(source_context)
+    next_ctx = _shallow_copy_context(source_context)
+    owned: Set[int] = {id(next_ctx)}
+    locations: List[str] = []
     flat: Dict[str, Any] = {}
     # 1) flatten
     for k, v in patch.items():
@@ -141,13 +677,21 @@ def apply_context_patch(source_context: Dict[str, Any], patch: Dict[str, Any], t
             resolved = resolve_binding(val, source_context, trace)
         else:
             resolved = val
-        set_context_value(next_ctx, path, resolved)
+        location = _set_value(next_ctx, path, resolved, source_context, owned)
+        if location is not None:
+            locations.append(location)
         if trace is not None:
-            trace.append({'action': 'set', 'path': path, 'value': resolved})
+            trace.append({'action': 'set', 'path': path, 'location': location, 'value': resolved})
     # 3) recompute derived
-    recompute_derived(next_ctx)
-    if trace is not None:
-        trace.append({'action': 'recompute_derived'})
+    if derived_inputs_written(locations) or not derived_is_current(next_ctx):
+        derived = _derived_values(next_ctx)
+        if derived is not None:
+            for path, value in zip(DERIVED_WRITE_PATHS, derived):
+                locations.append(_set_value(next_ctx, path, value, None, owned))
+        if trace is not None:
+            trace.append({'action': 'recompute_derived'})
+    if written is not None:
+        written.extend(locations)
     return next_ctx, trace
 
 
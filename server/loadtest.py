@@ -0,0 +1,455 @@
+"""
+Нагрузочный прогон Sandbox API (server.main:app).
+
+Генерирует смесь запросов к /api/start/, /api/action (события и веса из EVENT_RULES пресета),
+/apply-transition и /render-screen (синтетические корзины заданного размера) и печатает
+сравнимый отчёт: throughput, p50/p95/p99, доля ошибок, CPU/память процессов.
+
+    python -m server.loadtest --concurrency 32 --requests 5000            # in-process через ASGI
+    python -m server.loadtest --url http://127.0.0.1:8000 --duration 30 --server-pid 4242
+    python -m server.loadtest --output after.json --baseline before.json
+
+Осмысленные цифры для /api/action сейчас даёт только SANDBOX_PRESET=ecommerceDashboard:
+у avitoDemo EVENT_RULES ссылаются на рёбра, которых нет в датасете, а стартовый узел без экрана.
+Перед прогоном каждый эндпоинт и событие проверяются одним запросом; если что-то падает,
+прогон останавливается (или, с --allow-failing, продолжается с предупреждением в отчёте).
+Размер синтетической корзины (--cart-items) влияет только на /apply-transition и /render-screen:
+/api/action работает с контекстом пресета и читает из запроса лишь email.
+С --url EVENT_RULES и пресет сервера клиенту не видны: события задаются через --event-mix,
+а пресет в отчёте берётся из SANDBOX_PRESET клиента и помечается как непроверенный.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+
+ENDPOINTS: Tuple[str, ...] = ("start", "action", "apply", "render")
+CART_ENDPOINTS: Tuple[str, ...] = ("POST /apply-transition", "POST /render-screen")
+DEFAULT_ENDPOINT_WEIGHTS: Dict[str, float] = {"start": 1, "action": 6, "apply": 2, "render": 1}
+
+
+def parse_weights(raw: Optional[str]) -> Dict[str, float]:
+    """'checkemail=5,retryfromerror=1' -> {'checkemail': 5.0, 'retryfromerror': 1.0}"""
+    weights: Dict[str, float] = {}
+    if not raw:
+        return weights
+    for chunk in raw.split(","):
+        if not chunk.strip():
+            continue
+        name, _, weight = chunk.partition("=")
+        weights[name.strip().lower()] = float(weight) if weight.strip() else 1.0
+    return weights
+
+
+def default_event_mix(event_rules: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    """Веса событий по EVENT_RULES: события с keep_inputs (действия на экране) чаще, чем сбросы/ретраи."""
+    return {event: (3.0 if rule.get("keep_inputs", True) else 1.0) for event, rule in event_rules.items()}
+
+
+def build_synthetic_cart(items_count: int, groups_count: int = 4) -> Dict[str, Any]:
+    groups_count = max(1, min(groups_count, items_count or 1))
+    shop_groups: List[Dict[str, Any]] = [
+        {"shop_id": g + 1, "shop_name": f"Магазин {g + 1}", "items": []} for g in range(groups_count)
+    ]
+    for i in range(items_count):
+        item_id = 1000 + i
+        shop_groups[i % groups_count]["items"].append({
+            "id": item_id,
+            "advertisement": {"id": 50000 + i, "title": f"Товар {item_id}", "price": 1000 + (i * 37) % 90000},
+            "quantity": 1 + i % 3,
+            "selected": i % 5 != 0,
+            "liked": i % 7 == 0,
+            "price": 1000 + (i * 37) % 90000
+        })
+    return {
+        "cart_response": {
+            "id": 3,
+            "shop_groups": shop_groups,
+            "total_items_count": items_count,
+            "selected_items_count": sum(1 for g in shop_groups for it in g["items"] if it["selected"])
+        },
+        "data": {"cart": {"items": [{"id": 1000 + i, "price": 1000 + (i * 37) % 90000} for i in range(items_count)]}},
+        "selected_item_id": None
+    }
+
+
+def build_render_schema(items_count: int) -> Dict[str, Any]:
+    components: List[Dict[str, Any]] = [
+        {"id": "cart-title", "type": "text", "props": {"text": {"reference": "${cart_response.total_items_count}", "value": 0}}},
+        {"id": "cart-list", "type": "list", "props": {"items": {"reference": "${data.cart.items}", "value": []}}}
+    ]
+    for i in range(min(items_count, 50)):
+        path = f"cart_response.shop_groups.*.items[id={1000 + i}]"
+        components.append({
+            "id": f"cart-item-{i}",
+            "type": "row",
+            "props": {
+                "quantity": {"reference": f"${{{path}.quantity}}", "value": 1},
+                "title": {"reference": f"${{{path}.advertisement.title}}", "value": ""}
+            }
+        })
+    return {"id": "loadtest-cart", "components": components}
+
+
+def action_params(event: str, rng: random.Random) -> Dict[str, str]:
+    # handle_action читает из запроса только email, остальные параметры он игнорирует
+    params: Dict[str, str] = {"event": event}
+    if event == "checkemail":
+        params["email"] = rng.choice(["user@example.com", "qa.team@avito.ru", "not-an-email", ""])
+    return params
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank перцентиль по уже отсортированному списку."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _proc_sample(pid: int) -> Optional[Dict[str, float]]:
+    # Linux /proc: utime/stime в тиках (поля 14/15 stat), VmRSS в kB
+    try:
+        with open(f"/proc/{pid}/stat", "r") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        rss_kb = 0
+        with open(f"/proc/{pid}/status", "r") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                    break
+        return {"cpuSeconds": cpu_seconds, "rssMb": rss_kb / 1024.0}
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _self_sample() -> Dict[str, float]:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss: kB на Linux, байты на macOS
+    max_rss_mb = usage.ru_maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else usage.ru_maxrss / 1024.0
+    return {"cpuSeconds": usage.ru_utime + usage.ru_stime, "rssMb": max_rss_mb}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.status_codes: Dict[str, Dict[str, int]] = {}
+
+    def record(self, name: str, latency_ms: float, status: Optional[int]):
+        self.latencies.setdefault(name, []).append(latency_ms)
+        codes = self.status_codes.setdefault(name, {})
+        code_key = str(status) if status is not None else "exception"
+        codes[code_key] = codes.get(code_key, 0) + 1
+        if status is None or status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summarize(self, name: str, latencies: List[float], errors: int, wall_seconds: float) -> Dict[str, Any]:
+        ordered = sorted(latencies)
+        count = len(ordered)
+        return {
+            "requests": count,
+            "errors": errors,
+            "errorRate": round(errors / count, 4) if count else 0.0,
+            "throughputRps": round(count / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+            "latencyMs": {
+                "p50": round(percentile(ordered, 50), 3),
+                "p95": round(percentile(ordered, 95), 3),
+                "p99": round(percentile(ordered, 99), 3),
+                "max": round(ordered[-1], 3) if ordered else 0.0,
+                "mean": round(sum(ordered) / count, 3) if count else 0.0
+            },
+            "statusCodes": self.status_codes.get(name, {})
+        }
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, event_rules: Dict[str, Dict[str, Any]], preset: str,
+                 preset_verified: bool):
+        self.args = args
+        self.preset = preset
+        self.preset_verified = preset_verified
+        self.rng = random.Random(args.seed)
+        self.recorder = Recorder()
+
+        endpoint_weights = {**DEFAULT_ENDPOINT_WEIGHTS, **parse_weights(args.endpoint_mix)}
+        self.endpoints = [name for name in ENDPOINTS if endpoint_weights.get(name, 0) > 0]
+        self.endpoint_weights = [endpoint_weights[name] for name in self.endpoints]
+
+        event_weights = parse_weights(args.event_mix) or default_event_mix(event_rules)
+        self.events = [event for event, weight in event_weights.items() if weight > 0]
+        self.event_weights = [event_weights[event] for event in self.events]
+        if "action" in self.endpoints and args.url and not args.event_mix:
+            raise SystemExit("--url needs --event-mix for /api/action: the server's EVENT_RULES are not visible "
+                             "from the client (or drop action from --endpoint-mix)")
+        if "action" in self.endpoints and not self.events:
+            raise SystemExit("No events to send: EVENT_RULES is empty and --event-mix was not given")
+
+        self.cart_context = build_synthetic_cart(args.cart_items)
+        self.render_schema = build_render_schema(args.cart_items)
+        self.indexes = {"cart_response.shop_groups.*.items": "id"}
+        self.preflight_failures: Dict[str, str] = {}
+
+    def _next_request(self) -> Tuple[str, str, str, Dict[str, Any]]:
+        """(имя для отчёта, HTTP-метод, путь, kwargs для httpx)."""
+        endpoint = self.rng.choices(self.endpoints, weights=self.endpoint_weights)[0]
+        event = self.rng.choices(self.events, weights=self.event_weights)[0] if endpoint == "action" else None
+        return self._request_for(endpoint, event)
+
+    def _request_for(self, endpoint: str, event: Optional[str] = None) -> Tuple[str, str, str, Dict[str, Any]]:
+        if endpoint == "start":
+            return "GET /api/start/", "GET", "/api/start/", {}
+        if endpoint == "action":
+            params = action_params(event or "", self.rng)
+            return f"GET /api/action?event={event}", "GET", "/api/action", {"params": params}
+        if endpoint == "apply":
+            item_id = 1000 + self.rng.randrange(max(self.args.cart_items, 1))
+            body = {
+                "context": self.cart_context,
+                "patch": {
+                    "selected_item_id": item_id,
+                    f"cart_response.shop_groups.*.items[id={item_id}].quantity": 1 + self.rng.randrange(5)
+                },
+                "options": {"indexes": self.indexes}
+            }
+            return "POST /apply-transition", "POST", "/apply-transition", {"json": body}
+        body = {"schema": self.render_schema, "context": self.cart_context, "options": {"indexes": self.indexes}}
+        return "POST /render-screen", "POST", "/render-screen", {"json": body}
+
+    async def _worker(self, client: httpx.AsyncClient, deadline: Optional[float], budget: List[int]):
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if deadline is None:
+                if budget[0] <= 0:
+                    return
+                budget[0] -= 1
+            name, method, path, kwargs = self._next_request()
+            started = time.perf_counter()
+            status, _ = await self._send(client, method, path, kwargs)
+            self.recorder.record(name, (time.perf_counter() - started) * 1000.0, status)
+
+    @staticmethod
+    async def _send(client: httpx.AsyncClient, method: str, path: str, kwargs: Dict[str, Any]) -> Tuple[Optional[int], str]:
+        """(HTTP-статус или None при исключении, краткое описание ошибки)."""
+        try:
+            response = await client.request(method, path, **kwargs)
+        except Exception as exc:
+            # любая ошибка транспорта/приложения — это неудачный запрос, а не конец прогона
+            return None, f"{type(exc).__name__}: {exc}"
+        if response.status_code >= 400:
+            return response.status_code, response.text[:200]
+        return response.status_code, ""
+
+    def _make_client(self) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(self.args.timeout)
+        if self.args.url:
+            limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+            return httpx.AsyncClient(base_url=self.args.url.rstrip("/"), timeout=timeout, limits=limits)
+        from .main import app
+        # необработанные исключения приложения должны попадать в отчёт как 500, а не обрывать прогон
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        return httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=timeout)
+
+    async def _preflight(self, client: httpx.AsyncClient) -> Dict[str, str]:
+        """Один запрос на каждый эндпоинт и событие смеси; возвращает {запрос: причина} для упавших."""
+        probes = [(endpoint, None) for endpoint in self.endpoints if endpoint != "action"]
+        if "action" in self.endpoints:
+            probes.extend(("action", event) for event in self.events)
+        failures: Dict[str, str] = {}
+        for endpoint, event in probes:
+            name, method, path, kwargs = self._request_for(endpoint, event)
+            status, detail = await self._send(client, method, path, kwargs)
+            if status is None or status >= 400:
+                failures[name] = f"{status if status is not None else 'exception'} {detail}".strip()
+        return failures
+
+    async def _warmup(self, client: httpx.AsyncClient):
+        for _ in range(self.args.warmup):
+            _, method, path, kwargs = self._next_request()
+            await self._send(client, method, path, kwargs)
+
+    async def run(self) -> Dict[str, Any]:
+        pids = self.args.server_pid or []
+        async with self._make_client() as client:
+            self.preflight_failures = await self._preflight(client)
+            if self.preflight_failures:
+                listing = "\n".join(f"  {name}: {reason}" for name, reason in self.preflight_failures.items())
+                if not self.args.allow_failing:
+                    raise SystemExit(
+                        "Preflight failed, the numbers would mostly time instant errors:\n" + listing +
+                        "\nUse SANDBOX_PRESET=ecommerceDashboard for /api/action, drop the failing parts with "
+                        "--endpoint-mix/--event-mix, or pass --allow-failing to measure anyway."
+                    )
+                print("WARNING: these requests fail in preflight and will count as errors:\n" + listing, file=sys.stderr)
+            await self._warmup(client)
+            resources_before = {pid: _proc_sample(pid) for pid in pids}
+            self_before = _self_sample()
+            started = time.perf_counter()
+            deadline = started + self.args.duration if self.args.duration else None
+            budget = [self.args.requests]
+            await asyncio.gather(*(self._worker(client, deadline, budget) for _ in range(self.args.concurrency)))
+            wall_seconds = time.perf_counter() - started
+            self_after = _self_sample()
+            resources_after = {pid: _proc_sample(pid) for pid in pids}
+
+        return self._report(wall_seconds, self_before, self_after, resources_before, resources_after)
+
+    def _report(self, wall_seconds: float, self_before: Dict[str, float], self_after: Dict[str, float],
+                resources_before: Dict[int, Optional[Dict[str, float]]],
+                resources_after: Dict[int, Optional[Dict[str, float]]]) -> Dict[str, Any]:
+        recorder = self.recorder
+        endpoints = {
+            name: recorder.summarize(name, latencies, recorder.errors.get(name, 0), wall_seconds)
+            for name, latencies in sorted(recorder.latencies.items())
+        }
+        all_latencies = [value for latencies in recorder.latencies.values() for value in latencies]
+        overall = recorder.summarize("overall", all_latencies, sum(recorder.errors.values()), wall_seconds)
+        overall.pop("statusCodes", None)
+
+        workers: List[Dict[str, Any]] = [{
+            "worker": "loadgen" if self.args.url else "in-process (loadgen + app)",
+            "pid": os.getpid(),
+            "cpuSeconds": round(self_after["cpuSeconds"] - self_before["cpuSeconds"], 3),
+            "cpuPercent": round(100.0 * (self_after["cpuSeconds"] - self_before["cpuSeconds"]) / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+            "maxRssMb": round(self_after["rssMb"], 1)
+        }]
+        for pid, after in resources_after.items():
+            before = resources_before.get(pid)
+            if not before or not after:
+                workers.append({"worker": "server", "pid": pid, "error": "process stats unavailable"})
+                continue
+            cpu_seconds = after["cpuSeconds"] - before["cpuSeconds"]
+            workers.append({
+                "worker": "server",
+                "pid": pid,
+                "cpuSeconds": round(cpu_seconds, 3),
+                "cpuPercent": round(100.0 * cpu_seconds / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+                "rssMb": round(after["rssMb"], 1)
+            })
+
+        return {
+            "config": {
+                "target": self.args.url or "in-process ASGI",
+                "preset": self.preset,
+                "presetVerified": self.preset_verified,
+                "concurrency": self.args.concurrency,
+                "requests": self.args.requests if not self.args.duration else None,
+                "durationSeconds": self.args.duration or None,
+                "cartItems": self.args.cart_items,
+                "cartItemsAppliesTo": list(CART_ENDPOINTS),
+                "endpointMix": dict(zip(self.endpoints, self.endpoint_weights)),
+                "eventMix": dict(zip(self.events, self.event_weights)),
+                "seed": self.args.seed
+            },
+            "preflightFailures": self.preflight_failures,
+            "wallSeconds": round(wall_seconds, 3),
+            "overall": overall,
+            "endpoints": endpoints,
+            "workers": workers
+        }
+
+
+def format_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    def delta(current: float, previous: Optional[float]) -> str:
+        if previous is None or previous == 0:
+            return ""
+        return f" ({(current - previous) / previous * 100.0:+.1f}%)"
+
+    lines: List[str] = []
+    config = report["config"]
+    preset = config["preset"] if config.get("presetVerified", True) else f"{config['preset']}? (client SANDBOX_PRESET, unverified)"
+    lines.append(f"target={config['target']} preset={preset} concurrency={config['concurrency']} "
+                 f"cartItems={config['cartItems']} (apply-transition/render-screen only) wall={report['wallSeconds']}s")
+    for name, reason in (report.get("preflightFailures") or {}).items():
+        lines.append(f"WARNING preflight failed: {name}: {reason}")
+    header = f"{'endpoint':<44} {'reqs':>7} {'err%':>6} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"
+    lines.append(header)
+    lines.append("-" * len(header))
+    rows = list(report["endpoints"].items()) + [("overall", report["overall"])]
+    base_rows: Dict[str, Any] = {}
+    if baseline:
+        base_rows = {**baseline.get("endpoints", {}), "overall": baseline.get("overall", {})}
+    for name, stats in rows:
+        latency = stats["latencyMs"]
+        lines.append(
+            f"{name:<44} {stats['requests']:>7} {stats['errorRate'] * 100:>5.1f}% {stats['throughputRps']:>9.1f} "
+            f"{latency['p50']:>9.2f} {latency['p95']:>9.2f} {latency['p99']:>9.2f} {latency['max']:>9.2f}"
+        )
+        previous = base_rows.get(name)
+        if previous:
+            prev_latency = previous.get("latencyMs", {})
+            lines.append(
+                f"{'  vs baseline':<44} rps{delta(stats['throughputRps'], previous.get('throughputRps'))} "
+                f"p50{delta(latency['p50'], prev_latency.get('p50'))} "
+                f"p95{delta(latency['p95'], prev_latency.get('p95'))} "
+                f"p99{delta(latency['p99'], prev_latency.get('p99'))}"
+            )
+    lines.append("")
+    for worker in report["workers"]:
+        if "error" in worker:
+            lines.append(f"{worker['worker']} pid={worker['pid']}: {worker['error']}")
+            continue
+        memory = worker.get("maxRssMb", worker.get("rssMb"))
+        lines.append(f"{worker['worker']} pid={worker['pid']}: cpu={worker['cpuSeconds']}s "
+                     f"({worker['cpuPercent']}%) rss={memory}MB")
+    return "\n".join(lines)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m server.loadtest", description="Load test for the Sandbox API")
+    parser.add_argument("--url", help="Base URL of a running server (uvicorn); by default the app runs in-process via ASGI")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent virtual clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Total requests (ignored when --duration is set)")
+    parser.add_argument("--duration", type=float, default=0, help="Run for N seconds instead of a fixed request count")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests sent before the run")
+    parser.add_argument("--cart-items", type=int, default=200, help="Items in the synthetic cart sent to /apply-transition and /render-screen (no effect on /api/action)")
+    parser.add_argument("--endpoint-mix", help="Endpoint weights, e.g. 'start=1,action=6,apply=2,render=1'")
+    parser.add_argument("--event-mix", help="Event weights for /api/action, e.g. 'checkemail=5,retryfromerror=1' (default: from EVENT_RULES; required with --url)")
+    parser.add_argument("--server-pid", type=int, action="append", help="PID of a server worker to sample CPU/RSS from (repeatable, Linux)")
+    parser.add_argument("--allow-failing", action="store_true", help="Run even if some endpoints/events fail the preflight check")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout, seconds")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the request mix")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Previous JSON report to compare throughput and latency against")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.concurrency < 1:
+        raise SystemExit("--concurrency must be >= 1")
+
+    if args.url:
+        # пресет удалённого сервера не проверить — в отчёте это допущение клиента
+        load_test = LoadTest(args, {}, os.environ.get("SANDBOX_PRESET", "avitoDemo"), preset_verified=False)
+    else:
+        from .sandbox_flow import EVENT_RULES, PRESET_NAME
+        load_test = LoadTest(args, EVENT_RULES, PRESET_NAME, preset_verified=True)
+
+    report = asyncio.run(load_test.run())
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+    print(format_report(report, baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,8 @@ from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Any, Dict, Optional
-from .bindings import apply_context_patch, render_screen
-from .sandbox_flow import handle_action, start_response
+from .bindings import apply_context_patch, declare_context_index, render_screen
+from .sandbox_flow import handle_action, reload_dataset, start_response, transition_cache_stats
 
 app = FastAPI(title='Sandbox Binding API')
 
@@ -42,6 +42,16 @@ class RenderScreenResponse(BaseModel):
     trace: Optional[Any] = None
 
 
+def _with_indexes(context: Dict[str, Any], options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Объявляет вторичные индексы из options.indexes ({collection_path: key}) на context."""
+    indexes = (options or {}).get('indexes')
+    if not isinstance(indexes, dict):
+        return context
+    for collection_path, key in indexes.items():
+        context = declare_context_index(context, collection_path, key or 'id')
+    return context
+
+
 @app.get('/api/start/')
 def sandbox_start():
     """Возвращает стартовый экран и начальный контекст для песочницы."""
@@ -55,14 +65,32 @@ async def sandbox_action(request: Request, event: str = Query(..., description='
     return handle_action(event, params)
 
 
+@app.get('/api/transition-cache')
+def sandbox_transition_cache():
+    """Статистика кэша цепочек переходов (hits, misses, hitRate, size)."""
+    return transition_cache_stats()
+
+
+@app.post('/api/reload-dataset')
+def sandbox_reload_dataset():
+    """Перечитывает JSON пресета и сбрасывает кэш переходов."""
+    try:
+        reload_dataset()
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return transition_cache_stats()
+
+
 @app.post('/apply-transition', response_model=ApplyTransitionResponse)
 def apply_transition(req: ApplyTransitionRequest):
     """Endpoint: применяет patch к context и возвращает новый контекст.
-    Опционально возвращает trace при options.trace==True
+    Опционально возвращает trace при options.trace==True.
+    options.indexes ({collection_path: key}) включает адресацию элементов вида 'cart.items[id=42]'.
     """
     trace_enabled = bool(req.options and req.options.get('trace'))
     try:
-        next_ctx, trace = apply_context_patch(req.context, req.patch, trace_enabled=trace_enabled)
+        context = _with_indexes(req.context, req.options)
+        next_ctx, trace = apply_context_patch(context, req.patch, trace_enabled=trace_enabled)
         return {'next_context': next_ctx, 'trace': trace}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -74,7 +102,8 @@ def render_screen_endpoint(req: RenderScreenRequest):
     """
     trace_enabled = bool(req.options and req.options.get('trace'))
     try:
-        resolved, trace = render_screen(req.schema, req.context, trace_enabled=trace_enabled)
+        context = _with_indexes(req.context, req.options)
+        resolved, trace = render_screen(req.schema, context, trace_enabled=trace_enabled)
         return {'resolved_schema': resolved, 'trace': trace}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
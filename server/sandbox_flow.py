@@ -1,60 +1,71 @@
+import hashlib
 import json
 import os
 import re
+import threading
 from copy import deepcopy
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import HTTPException
 
-from .bindings import apply_context_patch, get_context_value, is_binding, resolve_binding
+from .bindings import (
+    DERIVED_READ_PATHS,
+    apply_context_patch,
+    apply_flat_values,
+    derived_inputs_written,
+    derived_is_current,
+    flatten_patch,
+    get_context_value,
+    is_binding,
+    locate_context_path,
+    normalize_reference,
+    paths_overlap,
+    resolve_binding,
+    selector_dependencies,
+)
+from .transition_cache import TransitionCache
 
 
 ROOT_DIR = Path(__file__).resolve().parents[1]
 PRESET_NAME = os.environ.get("SANDBOX_PRESET", "avitoDemo")
 DATASET_PATH = ROOT_DIR / f"src/pages/Sandbox/data/{PRESET_NAME}.json"
 
-try:
-    with DATASET_PATH.open("r", encoding="utf-8") as dataset_file:
-        _PRODUCT_DATA: Dict[str, Any] = json.load(dataset_file)
-except FileNotFoundError as exc:
-    raise RuntimeError(
-        f"Sandbox dataset not found at '{DATASET_PATH}'. "
-        "Ensure the JSON export exists so the API can mirror the sandbox."
-    ) from exc
-except json.JSONDecodeError as exc:
-    raise RuntimeError(
-        f"Sandbox dataset at '{DATASET_PATH}' is not a valid JSON document"
-    ) from exc
-
-
-_BASE_CONTEXT: Dict[str, Any] = deepcopy(_PRODUCT_DATA.get("initialContext") or {})
-_SCREEN_REGISTRY: Dict[str, Dict[str, Any]] = _PRODUCT_DATA.get("screens") or {}
-_NODE_REGISTRY: Dict[str, Dict[str, Any]] = {
-    node["id"]: node for node in _PRODUCT_DATA.get("nodes", []) if isinstance(node, dict) and node.get("id")
-}
-
-_EDGE_REGISTRY: Dict[str, Dict[str, Any]] = {}
-for node in _PRODUCT_DATA.get("nodes", []) or []:
-    node_id = node.get("id")
-    for edge in node.get("edges", []) or []:
-        if not isinstance(edge, dict) or not edge.get("id"):
-            continue
-        edge_copy = dict(edge)
-        edge_copy["source"] = node_id
-        _EDGE_REGISTRY[edge["id"]] = edge_copy
-
-
-def _find_start_node() -> Optional[str]:
+def _read_dataset() -> Dict[str, Any]:
+    try:
+        with DATASET_PATH.open("r", encoding="utf-8") as dataset_file:
+            return json.load(dataset_file)
+    except FileNotFoundError as exc:
+        raise RuntimeError(
+            f"Sandbox dataset not found at '{DATASET_PATH}'. "
+            "Ensure the JSON export exists so the API can mirror the sandbox."
+        ) from exc
+    except json.JSONDecodeError as exc:
+        raise RuntimeError(
+            f"Sandbox dataset at '{DATASET_PATH}' is not a valid JSON document"
+        ) from exc
+
+
+def _build_edge_registry(product_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    registry: Dict[str, Dict[str, Any]] = {}
+    for node in product_data.get("nodes", []) or []:
+        node_id = node.get("id")
+        for edge in node.get("edges", []) or []:
+            if not isinstance(edge, dict) or not edge.get("id"):
+                continue
+            edge_copy = dict(edge)
+            edge_copy["source"] = node_id
+            registry[edge["id"]] = edge_copy
+    return registry
+
+
+def _find_start_node(node_registry: Dict[str, Dict[str, Any]]) -> Optional[str]:
     """Find the start node dynamically from the dataset."""
-    for node_id, node in _NODE_REGISTRY.items():
+    for node_id, node in node_registry.items():
         if node.get("start") is True:
             return node_id
     # Fallback to first node if no start node marked
-    return next(iter(_NODE_REGISTRY.keys())) if _NODE_REGISTRY else None
-
-
-START_NODE_ID = _find_start_node()
+    return next(iter(node_registry.keys())) if node_registry else None
 
 
 DEFAULT_INPUTS: Dict[str, str] = {"email": ""}
@@ -83,21 +94,64 @@ else:
     }
 
 
+class _FlowDataset:
+    """
+    One loaded copy of the preset: registries, base context and memoized read paths.
+    Requests take a single reference to the current dataset, so a reload never mixes
+    old and new registries within one request.
+    """
+
+    def __init__(self, product_data: Dict[str, Any], generation: int):
+        self.generation = generation
+        self.product_data = product_data
+        self.screens: Dict[str, Dict[str, Any]] = product_data.get("screens") or {}
+        self.nodes: Dict[str, Dict[str, Any]] = {
+            node["id"]: node for node in product_data.get("nodes", []) if isinstance(node, dict) and node.get("id")
+        }
+        self.edges: Dict[str, Dict[str, Any]] = _build_edge_registry(product_data)
+        self.start_node_id: Optional[str] = _find_start_node(self.nodes)
+        self.chain_read_paths: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+
+        # No preset addresses items by [key=value] selectors yet, so the base context declares
+        # no secondary indexes; clients that need them pass options.indexes to /apply-transition.
+        self.base_context: Dict[str, Any] = deepcopy(product_data.get("initialContext") or {})
+
+
+# Memoized edge chains: (dataset generation, edge id, source node, fingerprint of the paths
+# the chain reads) -> (final node, composed flat patch). Cleared whenever the dataset is reloaded;
+# the generation keeps results of requests that were in flight during a reload unreachable.
+_TRANSITION_CACHE = TransitionCache(int(os.environ.get("SANDBOX_TRANSITION_CACHE_SIZE", "1024")))
+_RELOAD_LOCK = threading.Lock()
+_DATASET = _FlowDataset(_read_dataset(), 0)
+
+
+def reload_dataset() -> None:
+    """Re-read the preset JSON, swap in the new registries and drop memoized transitions."""
+    global _DATASET
+    with _RELOAD_LOCK:
+        _DATASET = _FlowDataset(_read_dataset(), _DATASET.generation + 1)
+        _TRANSITION_CACHE.clear()
+
+
+def transition_cache_stats() -> Dict[str, Any]:
+    return {**_TRANSITION_CACHE.stats(), "generation": _DATASET.generation}
+
+
 _BUTTON_EVENT_INJECTIONS: Dict[str, Dict[str, str]] = {}
 
 
-def _clone_base_context() -> Dict[str, Any]:
-    return deepcopy(_BASE_CONTEXT)
+def _clone_base_context(dataset: _FlowDataset) -> Dict[str, Any]:
+    return deepcopy(dataset.base_context)
 
 
-def _state_overrides_for_node(node_id: str) -> Dict[str, Any]:
-    node = _NODE_REGISTRY.get(node_id) or {}
+def _state_overrides_for_node(dataset: _FlowDataset, node_id: str) -> Dict[str, Any]:
+    node = dataset.nodes.get(node_id) or {}
     title = node.get("label") if isinstance(node.get("label"), str) else None
     return {"title": title.strip()} if title and title.strip() else {}
 
 
-def _resolve_screen_id(node_id: str) -> str:
-    node = _NODE_REGISTRY.get(node_id)
+def _resolve_screen_id(dataset: _FlowDataset, node_id: str) -> str:
+    node = dataset.nodes.get(node_id)
     if not node:
         raise HTTPException(status_code=500, detail=f"Unknown node '{node_id}' in sandbox flow")
     screen_id = node.get("screenId")
@@ -157,8 +211,8 @@ def _inject_button_events(screen_id: str, screen: Dict[str, Any]) -> None:
         component["event"] = event_name
 
 
-def _get_screen_payload(screen_id: str) -> Dict[str, Any]:
-    screen = _SCREEN_REGISTRY.get(screen_id)
+def _get_screen_payload(dataset: _FlowDataset, screen_id: str) -> Dict[str, Any]:
+    screen = dataset.screens.get(screen_id)
     if not isinstance(screen, dict):
         raise HTTPException(status_code=500, detail=f"Unknown screen '{screen_id}' in sandbox flow")
     screen_copy = deepcopy(screen)
@@ -202,6 +256,18 @@ def _is_empty_value(candidate: Any) -> bool:
     return False
 
 
+_REGEX_FLAGS: Dict[str, int] = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL}
+
+
+def _regex_flags(raw_flags: Any) -> int:
+    # datasets carry JavaScript-style flag strings ("i", "gi"); unsupported letters are ignored
+    flags = 0
+    if isinstance(raw_flags, str):
+        for letter in raw_flags:
+            flags |= _REGEX_FLAGS.get(letter, 0)
+    return flags
+
+
 def _evaluate_condition(condition: Dict[str, Any], context: Dict[str, Any]) -> bool:
     if not isinstance(condition, dict):
         return False
@@ -213,7 +279,7 @@ def _evaluate_condition(condition: Dict[str, Any], context: Dict[str, Any]) -> b
     if condition_type == "regex":
         pattern = condition.get("pattern") or ""
         if pattern:
-            flags = condition.get("flags") or ""
+            flags = _regex_flags(condition.get("flags"))
             try:
                 regex = re.compile(pattern, flags)
             except re.error:
@@ -260,10 +326,8 @@ def _resolve_condition_edge(node: Dict[str, Any], context: Dict[str, Any]) -> Op
     return None
 
 
-def _run_edge_sequence(edge_id: Optional[str], source_node_id: str, starting_context: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
-    if not edge_id:
-        return starting_context, source_node_id
-
+def _walk_edge_chain(dataset: _FlowDataset, edge_id: str, source_node_id: str, starting_context: Dict[str, Any],
+                     written_paths: List[str]) -> Tuple[Dict[str, Any], Optional[str]]:
     context = starting_context
     current_edge_id = edge_id
     current_source_node = source_node_id
@@ -271,16 +335,16 @@ def _run_edge_sequence(edge_id: Optional[str], source_node_id: str, starting_con
     last_target_node: Optional[str] = source_node_id
 
     while current_edge_id:
-        edge = _EDGE_REGISTRY.get(current_edge_id)
+        edge = dataset.edges.get(current_edge_id)
         if not edge:
             raise HTTPException(status_code=500, detail=f"Edge '{current_edge_id}' is not defined in sandbox flow")
         if edge.get("source") and edge["source"] != current_source_node:
             raise HTTPException(status_code=500, detail=f"Edge '{current_edge_id}' is not connected to node '{current_source_node}'")
 
-        context, _ = apply_context_patch(context, edge.get("contextPatch") or {}, trace_enabled=False)
+        context, _ = apply_context_patch(context, edge.get("contextPatch") or {}, written=written_paths)
         last_target_node = edge.get("target") or last_target_node
 
-        target_node = _NODE_REGISTRY.get(edge.get("target")) if edge.get("target") else None
+        target_node = dataset.nodes.get(edge.get("target")) if edge.get("target") else None
         if not target_node or target_node.get("type") != "action":
             return context, target_node.get("id") if target_node else last_target_node
 
@@ -298,6 +362,142 @@ def _run_edge_sequence(edge_id: Optional[str], source_node_id: str, starting_con
     return context, last_target_node
 
 
+def _flat_patch_paths(patch: Dict[str, Any]) -> List[str]:
+    flat: Dict[str, Any] = {}
+    for key, value in patch.items():
+        flatten_patch(key, value, flat)
+    return list(flat.keys())
+
+
+def _collect_binding_references(value: Any, paths: List[str]) -> None:
+    if is_binding(value):
+        paths.append(normalize_reference(value["reference"]))
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_binding_references(item, paths)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_binding_references(item, paths)
+
+
+def _collect_condition_paths(condition: Any, paths: List[str]) -> None:
+    if not isinstance(condition, dict):
+        return
+    source = condition.get("source")
+    path = condition.get("path")
+    if source is not None:
+        if is_binding(source):
+            paths.append(normalize_reference(source["reference"]))
+        elif isinstance(source, str) and source.startswith("${") and source.endswith("}"):
+            paths.append(normalize_reference(source))
+    elif isinstance(path, str) and path.strip():
+        paths.append(path.strip())
+
+
+def _edge_chain_read_paths(dataset: _FlowDataset, edge_id: str, source_node_id: str) -> Tuple[str, ...]:
+    """
+    Context paths any chain starting at edge_id may read: binding references in patches,
+    condition sources of every reachable action node, selector targets of patch keys
+    and, if the chain writes them, the inputs of recompute_derived(). Computed once per
+    edge from the static graph.
+    """
+    cache_key = (edge_id, source_node_id)
+    cached = dataset.chain_read_paths.get(cache_key)
+    if cached is not None:
+        return cached
+
+    paths: List[str] = []
+    written: List[str] = []
+    pending = [edge_id]
+    visited = set()
+    while pending:
+        current_edge_id = pending.pop()
+        if current_edge_id in visited:
+            continue
+        visited.add(current_edge_id)
+        edge = dataset.edges.get(current_edge_id)
+        if not edge:
+            continue
+        context_patch = edge.get("contextPatch") or {}
+        _collect_binding_references(context_patch, paths)
+        patch_paths = _flat_patch_paths(context_patch)
+        written.extend(patch_paths)
+        # keys like "items[id=42].quantity" depend on where the item currently sits
+        paths.extend(path for path in patch_paths if "[" in path)
+
+        target_node = dataset.nodes.get(edge.get("target")) if edge.get("target") else None
+        if not target_node or target_node.get("type") != "action":
+            continue
+        config = target_node.get("data", {}).get("config", {}) if isinstance(target_node.get("data"), dict) else {}
+        for condition in config.get("conditions") or []:
+            _collect_condition_paths(condition, paths)
+        for next_edge in target_node.get("edges") or []:
+            if isinstance(next_edge, dict) and next_edge.get("id"):
+                pending.append(next_edge["id"])
+
+    for path in list(paths):
+        for dependency in selector_dependencies(path):
+            if dependency.reference:
+                paths.append(dependency.reference)
+            # The fingerprint stores where the selector points in the starting context. That only
+            # holds for the whole chain if no edge moves the items, rewrites their keys or the reference.
+            moved = any(
+                paths_overlap(target, dependency.item_keys)
+                or (dependency.reference and paths_overlap(target, dependency.reference))
+                for target in written
+            )
+            if moved and dependency.collection:
+                paths.append(dependency.collection)
+    if derived_inputs_written(written):
+        paths.extend(DERIVED_READ_PATHS)
+    result = tuple(dict.fromkeys(paths))
+    dataset.chain_read_paths[cache_key] = result
+    return result
+
+
+def _fingerprint_paths(context: Dict[str, Any], paths: Tuple[str, ...]) -> str:
+    values: List[Any] = []
+    for path in paths:
+        if "[" in path:
+            values.append([locate_context_path(context, path), get_context_value(context, path)])
+        else:
+            values.append(get_context_value(context, path))
+    encoded = json.dumps(values, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+def _compose_flat_patch(final_context: Dict[str, Any], written_paths: List[str]) -> Tuple[Tuple[str, Any], ...]:
+    # Replay order matters: keep the last write of each path and drop writes that a later
+    # write to the same path or an ancestor overrides ('a.b' then 'a' leaves only 'a').
+    kept: List[str] = []
+    for path in reversed(written_paths):
+        if any(path == later or path.startswith(later + ".") for later in kept):
+            continue
+        kept.append(path)
+    return tuple((path, deepcopy(get_context_value(final_context, path))) for path in reversed(kept))
+
+
+def _run_edge_sequence(dataset: _FlowDataset, edge_id: Optional[str], source_node_id: str,
+                       starting_context: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    if not edge_id:
+        return starting_context, source_node_id
+
+    read_paths = _edge_chain_read_paths(dataset, edge_id, source_node_id)
+    if not derived_is_current(starting_context):
+        # the first patch of the chain will run recompute_derived() regardless of what it writes
+        read_paths += DERIVED_READ_PATHS
+    cache_key = (dataset.generation, edge_id, source_node_id, _fingerprint_paths(starting_context, read_paths))
+    cached = _TRANSITION_CACHE.get(cache_key)
+    if cached is not None:
+        final_node_id, flat_patch = cached
+        return apply_flat_values(starting_context, ((path, deepcopy(value)) for path, value in flat_patch)), final_node_id
+
+    written_paths: List[str] = []
+    context, final_node_id = _walk_edge_chain(dataset, edge_id, source_node_id, starting_context, written_paths)
+    _TRANSITION_CACHE.put(cache_key, (final_node_id, _compose_flat_patch(context, written_paths)))
+    return context, final_node_id
+
+
 def _build_dynamic_patch(event: str, inputs: Dict[str, str]) -> Dict[str, Any]:
     patch: Dict[str, Any] = {}
     email = inputs.get("email")
@@ -374,9 +574,9 @@ def _build_api_context(core_ctx: Dict[str, Any], inputs: Dict[str, str], state_o
     return context_payload
 
 
-def _make_screen_response(screen_id: str, context: Dict[str, Any]) -> Dict[str, Any]:
+def _make_screen_response(dataset: _FlowDataset, screen_id: str, context: Dict[str, Any]) -> Dict[str, Any]:
     return {
-        "screen": _get_screen_payload(screen_id),
+        "screen": _get_screen_payload(dataset, screen_id),
         "context": context
     }
 
@@ -394,12 +594,14 @@ def _extract_form_values(params: Dict[str, Any]) -> Dict[str, str]:
 
 
 def start_response() -> Dict[str, Any]:
-    if not START_NODE_ID:
+    dataset = _DATASET
+    start_node_id = dataset.start_node_id
+    if not start_node_id:
         raise HTTPException(status_code=500, detail="No start node found in dataset")
-    core_context = _clone_base_context()
-    context = _build_api_context(core_context, DEFAULT_INPUTS, _state_overrides_for_node(START_NODE_ID))
-    screen_id = _resolve_screen_id(START_NODE_ID)
-    return _make_screen_response(screen_id, context)
+    core_context = _clone_base_context(dataset)
+    context = _build_api_context(core_context, DEFAULT_INPUTS, _state_overrides_for_node(dataset, start_node_id))
+    screen_id = _resolve_screen_id(dataset, start_node_id)
+    return _make_screen_response(dataset, screen_id, context)
 
 
 def handle_action(event: str, params: Dict[str, Any]) -> Dict[str, Any]:
@@ -421,16 +623,18 @@ def handle_action(event: str, params: Dict[str, Any]) -> Dict[str, Any]:
 
     dynamic_patch = _build_dynamic_patch(normalized_event, inputs_for_patch)
 
-    base_context = _clone_base_context()
-    context_with_inputs = _apply_patch_to_context(base_context, dynamic_patch)
+    dataset = _DATASET
+    # Patches are applied copy-on-write, so the shared base context is never mutated and
+    # _build_api_context copies whatever ends up in the response.
+    context_with_inputs = _apply_patch_to_context(dataset.base_context, dynamic_patch)
 
-    context_after_flow, final_node_id = _run_edge_sequence(rule["edge_id"], rule["source_node"], context_with_inputs)
+    context_after_flow, final_node_id = _run_edge_sequence(dataset, rule["edge_id"], rule["source_node"], context_with_inputs)
     if not final_node_id:
         raise HTTPException(status_code=500, detail=f"Event '{event}' did not resolve to a target node")
 
     keep_inputs = rule.get("keep_inputs", True)
     inputs_for_context = inputs_for_patch if keep_inputs else deepcopy(DEFAULT_INPUTS)
 
-    screen_id = _resolve_screen_id(final_node_id)
-    context = _build_api_context(context_after_flow, inputs_for_context, _state_overrides_for_node(final_node_id))
-    return _make_screen_response(screen_id, context)
+    screen_id = _resolve_screen_id(dataset, final_node_id)
+    context = _build_api_context(context_after_flow, inputs_for_context, _state_overrides_for_node(dataset, final_node_id))
+    return _make_screen_response(dataset, screen_id, context)
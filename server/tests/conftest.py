@@ -0,0 +1,21 @@
+import importlib
+import sys
+
+import pytest
+
+
+def _reload_flow():
+    module = importlib.reload(importlib.import_module("server.sandbox_flow"))
+    # main импортирует обработчики из sandbox_flow по имени — перезагружаем и его
+    if "server.main" in sys.modules:
+        importlib.reload(sys.modules["server.main"])
+    return module
+
+
+@pytest.fixture
+def ecommerce_flow(monkeypatch):
+    """sandbox_flow с пресетом ecommerceDashboard и собственным кэшем переходов; после теста пресет восстанавливается."""
+    monkeypatch.setenv("SANDBOX_PRESET", "ecommerceDashboard")
+    yield _reload_flow()
+    monkeypatch.undo()
+    _reload_flow()
@@ -0,0 +1,150 @@
+from copy import deepcopy
+
+from server.bindings import (
+    _parse_path,
+    _KeySelector,
+    apply_context_patch,
+    declare_context_index,
+    get_context_value,
+    locate_context_path,
+    rebuild_context_indexes,
+    set_context_value,
+)
+
+
+def make_cart():
+    return {
+        'selected_item_id': 42,
+        'cart': {'items': [{'id': 1, 'quantity': 1}, {'id': 42, 'quantity': 2}, {'id': 7, 'quantity': 3}]},
+        'cart_response': {'shop_groups': [
+            {'items': [{'id': 10, 'advertisement': {'id': 100}}]},
+            {'items': [{'id': 11, 'advertisement': {'id': 101}}, {'id': 42, 'advertisement': {'id': 102}}]},
+        ]},
+    }
+
+
+def make_indexed_cart():
+    ctx = declare_context_index(make_cart(), 'cart.items')
+    return declare_context_index(ctx, 'cart_response.shop_groups.*.items')
+
+
+def test_parse_path_splits_selectors():
+    assert _parse_path('cart.items[id=42].quantity') == ('cart', 'items', _KeySelector('id', '42'), 'quantity')
+    assert _parse_path('a.*.items[advertisement.id=1.5]') == ('a', '*', 'items', _KeySelector('advertisement.id', '1.5'))
+    assert _parse_path('items[id=${selected_item_id}]') == ('items', _KeySelector('id', '${selected_item_id}'))
+
+
+def test_get_with_selector_without_index():
+    ctx = make_cart()
+    assert get_context_value(ctx, 'cart.items[id=42].quantity') == 2
+    assert get_context_value(ctx, 'cart_response.shop_groups.*.items[advertisement.id=101].id') == 11
+    assert get_context_value(ctx, 'cart.items[id=999]') is None
+    assert get_context_value(ctx, 'cart.items.*.id') is None
+
+
+def test_get_with_index_and_reference_selector():
+    ctx = make_indexed_cart()
+    assert locate_context_path(ctx, 'cart_response.shop_groups.*.items[id=42]') == 'cart_response.shop_groups.1.items.1'
+    assert locate_context_path(ctx, 'cart_response.shop_groups.0.items[id=42]') is None
+    assert get_context_value(ctx, 'cart.items[id=${selected_item_id}].quantity') == 2
+
+
+def test_set_with_selector_and_missing_item():
+    ctx = make_indexed_cart()
+    set_context_value(ctx, 'cart.items[id=42].quantity', 5)
+    assert ctx['cart']['items'][1]['quantity'] == 5
+    before = deepcopy(ctx)
+    set_context_value(ctx, 'cart.items[id=999].quantity', 5)
+    assert ctx == before
+
+
+def test_set_non_digit_segment_on_list_replaces_list():
+    ctx = {'a': [1, 2]}
+    set_context_value(ctx, 'a.foo', 1)
+    assert ctx == {'a': {'foo': 1}}
+    ctx = {'a': [{'x': 1}]}
+    set_context_value(ctx, 'a.0.x', 2)
+    assert ctx == {'a': [{'x': 2}]}
+
+
+def test_index_item_replaced():
+    ctx = make_indexed_cart()
+    set_context_value(ctx, 'cart.items.1', {'id': 50, 'quantity': 1})
+    assert locate_context_path(ctx, 'cart.items[id=50]') == 'cart.items.1'
+    assert locate_context_path(ctx, 'cart.items[id=42]') is None
+
+
+def test_index_key_changed():
+    ctx = make_indexed_cart()
+    set_context_value(ctx, 'cart_response.shop_groups.*.items[id=42].id', 43)
+    assert locate_context_path(ctx, 'cart_response.shop_groups.*.items[id=43]') == 'cart_response.shop_groups.1.items.1'
+    assert locate_context_path(ctx, 'cart_response.shop_groups.*.items[id=42]') is None
+
+
+def test_index_list_replaced():
+    ctx = make_indexed_cart()
+    set_context_value(ctx, 'cart.items', [{'id': 9}, {'id': 1}])
+    assert locate_context_path(ctx, 'cart.items[id=1]') == 'cart.items.1'
+    assert locate_context_path(ctx, 'cart.items[id=42]') is None
+
+
+def test_index_rebuild_after_direct_mutation():
+    ctx = make_indexed_cart()
+    rebuild_context_indexes(ctx)
+    ctx['cart']['items'].insert(0, {'id': 5})
+    # устаревшее попадание перестраивает индекс само
+    assert locate_context_path(ctx, 'cart.items[id=42]') == 'cart.items.2'
+    ctx['cart']['items'].append({'id': 6})
+    # промах достоверен только после явной перестройки
+    assert locate_context_path(ctx, 'cart.items[id=6]') is None
+    rebuild_context_indexes(ctx)
+    assert locate_context_path(ctx, 'cart.items[id=6]') == 'cart.items.4'
+
+
+def test_apply_patch_keeps_source_and_index_independent():
+    ctx = make_indexed_cart()
+    next_ctx, _ = apply_context_patch(ctx, {
+        'cart.items[id=${selected_item_id}].quantity': 9,
+        'cart.items.0.id': 2,
+        'copied': {'reference': '${cart.items[id=42].quantity}'},
+    })
+    assert get_context_value(next_ctx, 'cart.items[id=42].quantity') == 9
+    assert next_ctx['copied'] == 2
+    assert locate_context_path(next_ctx, 'cart.items[id=2]') == 'cart.items.0'
+    assert get_context_value(ctx, 'cart.items[id=42].quantity') == 2
+    assert locate_context_path(ctx, 'cart.items[id=1]') == 'cart.items.0'
+    assert locate_context_path(ctx, 'cart.items[id=2]') is None
+
+
+def test_duplicate_keys_resolve_to_first_item_with_and_without_index():
+    cart = {'cart': {'items': [{'id': 1, 'n': 'a'}, {'id': 42, 'n': 'b'}, {'id': 42, 'n': 'c'}]}}
+    ctx = declare_context_index(deepcopy(cart), 'cart.items')
+    assert get_context_value(cart, 'cart.items[id=42].n') == 'b'
+    assert get_context_value(ctx, 'cart.items[id=42].n') == 'b'
+    # первый дубликат сменил ключ — селектор находит следующий, как и линейный поиск
+    set_context_value(ctx, 'cart.items.1.id', 2)
+    assert get_context_value(ctx, 'cart.items[id=42].n') == 'c'
+    # новый дубликат позади существующего не перехватывает ключ
+    set_context_value(ctx, 'cart.items.0.id', 42)
+    assert get_context_value(ctx, 'cart.items[id=42].n') == 'a'
+
+
+def test_apply_patch_copies_only_written_path():
+    ctx = make_indexed_cart()
+    assert locate_context_path(ctx, 'cart.items[id=42]') == 'cart.items.1'
+    # одиночный поиск идёт линейно, индекс строится только перед копированием
+    assert not ctx.indexes[0].built
+    next_ctx, _ = apply_context_patch(ctx, {'cart.items[id=42].quantity': 5})
+    assert ctx.indexes[0].built
+    assert next_ctx['cart_response'] is ctx['cart_response']
+    assert next_ctx['cart']['items'][0] is ctx['cart']['items'][0]
+    assert next_ctx['cart']['items'][1] is not ctx['cart']['items'][1]
+    assert ctx['cart']['items'][1]['quantity'] == 2
+    # запись не по ключу индекса не копирует индекс
+    assert [id(i) for i in next_ctx.indexes] == [id(i) for i in ctx.indexes]
+    # а запись ключа копирует только индекс своей коллекции
+    next_ctx, _ = apply_context_patch(ctx, {'cart.items.1.id': 43})
+    assert next_ctx.indexes[0] is not ctx.indexes[0] and next_ctx.indexes[1] is ctx.indexes[1]
+    assert locate_context_path(next_ctx, 'cart.items[id=43]') == 'cart.items.1'
+    assert locate_context_path(ctx, 'cart.items[id=42]') == 'cart.items.1'
+    assert locate_context_path(ctx, 'cart.items[id=43]') is None
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from server import loadtest
+from server.loadtest import format_report, parse_weights, percentile
+
+
+def make_report(rps, p50):
+    stats = {"requests": 10, "errorRate": 0.0, "throughputRps": rps,
+             "latencyMs": {"p50": p50, "p95": p50 * 2, "p99": p50 * 3, "max": p50 * 4}}
+    return {
+        "config": {"target": "in-process ASGI", "preset": "ecommerceDashboard", "presetVerified": True,
+                   "concurrency": 2, "cartItems": 5},
+        "wallSeconds": 1.0,
+        "overall": stats,
+        "endpoints": {"GET /api/start/": stats},
+        "workers": [],
+    }
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 50) == 0.0
+    assert percentile([7.0], 0) == percentile([7.0], 99) == 7.0
+    values = [float(v) for v in range(1, 11)]
+    assert percentile(values, 0) == 1.0
+    assert percentile(values, 50) == 5.0
+    assert percentile(values, 51) == 6.0
+    assert percentile(values, 95) == 10.0
+    assert percentile(values, 100) == 10.0
+    assert percentile([float(v) for v in range(1, 101)], 99) == 99.0
+
+
+def test_parse_weights():
+    assert parse_weights(None) == {}
+    assert parse_weights("") == {}
+    assert parse_weights("CheckEmail=5, retryFromError=0.5,,start") == {
+        "checkemail": 5.0, "retryfromerror": 0.5, "start": 1.0
+    }
+    with pytest.raises(ValueError):
+        parse_weights("checkemail=often")
+
+
+def test_format_report_with_baseline():
+    text = format_report(make_report(rps=200.0, p50=5.0), make_report(rps=100.0, p50=10.0))
+    assert "preset=ecommerceDashboard " in text
+    baseline_lines = [line for line in text.splitlines() if line.startswith("  vs baseline")]
+    assert len(baseline_lines) == 2
+    assert "rps (+100.0%)" in baseline_lines[0] and "p50 (-50.0%)" in baseline_lines[0]
+
+
+def test_format_report_marks_unverified_preset():
+    report = make_report(rps=1.0, p50=1.0)
+    report["config"]["presetVerified"] = False
+    assert "preset=ecommerceDashboard? (client SANDBOX_PRESET, unverified)" in format_report(report)
+
+
+def test_url_mode_requires_event_mix():
+    with pytest.raises(SystemExit, match="--event-mix"):
+        loadtest.main(["--url", "http://127.0.0.1:1", "--requests", "1"])
+
+
+def test_in_process_run(ecommerce_flow, tmp_path, capsys):
+    output = tmp_path / "report.json"
+    assert loadtest.main(["--requests", "10", "--concurrency", "2", "--cart-items", "5", "--output", str(output)]) == 0
+    report = json.loads(output.read_text(encoding="utf-8"))
+    assert set(report) == {"config", "preflightFailures", "wallSeconds", "overall", "endpoints", "workers"}
+    assert report["config"]["preset"] == "ecommerceDashboard" and report["config"]["presetVerified"]
+    assert report["preflightFailures"] == {}
+    assert report["overall"]["requests"] == 10
+    assert report["overall"]["errorRate"] == 0.0
+    assert all(stats["errorRate"] == 0.0 for stats in report["endpoints"].values())
+    assert "overall" in capsys.readouterr().out
@@ -0,0 +1,114 @@
+import itertools
+import re
+from copy import deepcopy
+
+import pytest
+
+_generations = itertools.count(1000)
+
+
+@pytest.fixture
+def sandbox_flow(ecommerce_flow):
+    return ecommerce_flow
+
+
+def make_dataset(flow, *context_patches):
+    """Цепочка cart -> action-1 -> ... -> done, по одному contextPatch на ребро; у каждого датасета своё поколение."""
+    nodes = [{"id": "cart", "type": "screen"}]
+    nodes.extend({"id": f"action-{i}", "type": "action"} for i in range(1, len(context_patches)))
+    nodes.append({"id": "done", "type": "screen"})
+    for i, patch in enumerate(context_patches):
+        edge_id = "edit" if i == 0 else f"edit-{i}"
+        nodes[i]["edges"] = [{"id": edge_id, "target": nodes[i + 1]["id"], "contextPatch": patch}]
+    return flow._FlowDataset({"initialContext": {}, "nodes": nodes}, generation=next(_generations))
+
+
+def run_twice(flow, dataset, start):
+    expected, node = flow._walk_edge_chain(dataset, "edit", "cart", deepcopy(start), [])
+    first, _ = flow._run_edge_sequence(dataset, "edit", "cart", deepcopy(start))
+    second, second_node = flow._run_edge_sequence(dataset, "edit", "cart", deepcopy(start))
+    assert first == expected == second
+    assert second_node == node == "done"
+    return second
+
+
+def test_cached_handle_action_matches_uncached(sandbox_flow, monkeypatch):
+    for email in ["user@example.com", "not-an-email"]:
+        params = {"event": "checkemail", "email": email}
+        miss = sandbox_flow.handle_action("checkemail", params)
+        hit = sandbox_flow.handle_action("checkemail", params)
+        assert hit == miss
+
+    stats = sandbox_flow.transition_cache_stats()
+    assert stats["hits"] == 2
+
+    monkeypatch.setattr(sandbox_flow._TRANSITION_CACHE, "max_size", 0)
+    sandbox_flow._TRANSITION_CACHE.clear()
+    uncached = sandbox_flow.handle_action("checkemail", {"event": "checkemail", "email": "user@example.com"})
+    assert uncached == sandbox_flow.handle_action("checkemail", {"event": "checkemail", "email": "user@example.com"})
+    assert uncached["context"]["state"]["status"] == "success"
+
+
+def test_handle_action_keeps_base_context(sandbox_flow):
+    before = deepcopy(sandbox_flow._DATASET.base_context)
+    for _ in range(2):
+        sandbox_flow.handle_action("checkemail", {"event": "checkemail", "email": "user@example.com"})
+    assert sandbox_flow._DATASET.base_context == before
+
+
+def test_reload_clears_cache_and_bumps_generation(sandbox_flow):
+    sandbox_flow.handle_action("checkemail", {"event": "checkemail", "email": "user@example.com"})
+    before = sandbox_flow.transition_cache_stats()
+    sandbox_flow.reload_dataset()
+    after = sandbox_flow.transition_cache_stats()
+    assert after["size"] == 0
+    assert after["generation"] == before["generation"] + 1
+    assert after["invalidations"] == before["invalidations"] + 1
+
+
+def test_replay_uses_location_of_written_item(sandbox_flow):
+    dataset = make_dataset(sandbox_flow, {"items[id=42].id": 43})
+    result = run_twice(sandbox_flow, dataset, {"items": [{"id": 1}, {"id": 42}]})
+    assert result["items"] == [{"id": 1}, {"id": 43}]
+
+
+def test_replay_keeps_last_write_of_overwritten_path(sandbox_flow):
+    dataset = make_dataset(sandbox_flow, {"a": "x"}, {"a.b": 1}, {"a": "y"})
+    assert sandbox_flow._run_edge_sequence(dataset, "edit", "cart", {})[0]["a"] == "y"
+    assert run_twice(sandbox_flow, dataset, {})["a"] == "y"
+
+
+def test_reference_selector_is_part_of_fingerprint(sandbox_flow):
+    dataset = make_dataset(sandbox_flow, {"items[id=${selected_item_id}].quantity": 5})
+    items = [{"id": 1, "quantity": 1}, {"id": 42, "quantity": 1}]
+    first, _ = sandbox_flow._run_edge_sequence(dataset, "edit", "cart", {"selected_item_id": 42, "items": deepcopy(items)})
+    second, _ = sandbox_flow._run_edge_sequence(dataset, "edit", "cart", {"selected_item_id": 1, "items": deepcopy(items)})
+    assert [item["quantity"] for item in first["items"]] == [1, 5]
+    assert [item["quantity"] for item in second["items"]] == [5, 1]
+
+
+def test_read_paths_include_collection_only_when_chain_rewrites_it(sandbox_flow):
+    selector = "items[id=${selected_item_id}].quantity"
+    dataset = make_dataset(sandbox_flow, {selector: 5})
+    assert sandbox_flow._edge_chain_read_paths(dataset, "edit", "cart") == (selector, "selected_item_id")
+
+    dataset = make_dataset(sandbox_flow, {"items": [{"id": 2}, {"id": 1}]}, {selector: 5})
+    assert "items" in sandbox_flow._edge_chain_read_paths(dataset, "edit", "cart")
+    result = run_twice(sandbox_flow, dataset, {"selected_item_id": 1, "items": [{"id": 1}]})
+    assert result["items"] == [{"id": 2}, {"id": 1, "quantity": 5}]
+
+
+def test_derived_inputs_are_read_only_when_chain_writes_cart(sandbox_flow):
+    dataset = make_dataset(sandbox_flow, {"data.user.email": "a@b.c"})
+    assert sandbox_flow._edge_chain_read_paths(dataset, "edit", "cart") == ()
+    dataset = make_dataset(sandbox_flow, {"data.cart.items": []})
+    assert sandbox_flow._edge_chain_read_paths(dataset, "edit", "cart") == ("data.cart.items",)
+
+
+def test_regex_flags_from_javascript_strings(sandbox_flow):
+    assert sandbox_flow._regex_flags("i") == re.IGNORECASE
+    assert sandbox_flow._regex_flags("gim") == re.IGNORECASE | re.MULTILINE
+    assert sandbox_flow._regex_flags("") == 0
+    assert sandbox_flow._regex_flags(None) == 0
+    condition = {"type": "regex", "path": "inputs.email", "pattern": "^[A-Z]+@[A-Z]+\\.[A-Z]+$", "flags": "i"}
+    assert sandbox_flow._evaluate_condition(condition, {"inputs": {"email": "qa@example.com"}})
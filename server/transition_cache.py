@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class TransitionCache:
+    """
+    LRU-кэш результатов цепочек переходов: ключ -> (финальный узел, плоский patch).
+    Потокобезопасен (sync-эндпоинты FastAPI выполняются в threadpool) и считает hit/miss.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max(int(max_size), 0)
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: Any):
+        if self.max_size == 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Сбрасывает записи (например, при перезагрузке датасета); счётчики hit/miss сохраняются."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "invalidations": self.invalidations
+            }